@@ -16,11 +16,21 @@
 """Deterministic velocity fields for advection-diffusion equation."""
 import enum
 from typing import Any, Tuple, TypeVar
-import warnings
 
 import numpy as np
 from datadrivenpdes.core import grids
 import tensorflow as tf
+from tensorflow.python.eager import context  # pylint: disable=g-direct-tensorflow-import
+
+try:
+  import numexpr  # pylint: disable=g-import-not-at-top
+except ImportError:
+  numexpr = None
+
+try:
+  import numba  # pylint: disable=g-import-not-at-top
+except ImportError:
+  numba = None
 
 
 class VelocityComponent(enum.Enum):
@@ -53,7 +63,7 @@ class VelocityField:
 
     Returns:
       x component of the velocity field as tensor with
-      shape=[grid.size_x, grid.size_y] and dtype=float64.
+      shape=[grid.size_x, grid.size_y] and the field's dtype.
     """
     raise NotImplementedError
 
@@ -75,24 +85,115 @@ class VelocityField:
 
     Returns:
       y component of the velocity field as tensor with
-      shape=[grid.size_x, grid.size_y] and dtype=float64.
+      shape=[grid.size_x, grid.size_y] and the field's dtype.
     """
     raise NotImplementedError
 
 
-def _block_average_of_sin(k, x, phi, grid_step):
-  """Integral of sin(k * x + phi) over [x - grid_step/2, x + grid_step/2]."""
-  # Based on the indefinite integral:
-  #   \int sin(k x + phi) dx = -cos(k x + phi) / k + C
-  x0 = x - grid_step / 2
-  x1 = x + grid_step / 2
-  with warnings.catch_warnings():
-    warnings.simplefilter('ignore')  # ignore warnings for division by 0
-    return np.where(
-        k == 0,
-        np.sin(phi),
-        1 / (grid_step * k) * (np.cos(k * x0 + phi) - np.cos(k * x1 + phi))
-    )
+def _sin_of_phase(x, y, k_x, k_y, phase_shifts):
+  """Elementwise sin(k_x * x + k_y * y + phase_shifts), with broadcasting."""
+  # numexpr doesn't broadcast zero-size arrays (e.g., for a field without any
+  # contributing terms) to the full shape, but numpy handles them for free.
+  if numexpr is not None and np.size(phase_shifts):
+    # numexpr fuses the phase calculation and sin() into a single pass,
+    # without allocating full-size temporaries for the intermediate sums
+    return numexpr.evaluate('sin(k_x * x + k_y * y + phase_shifts)')
+  return np.sin(k_x * x + k_y * y + phase_shifts)
+
+
+def _sum_of_sines(x, y, terms):
+  """Weighted sum of sin(k_x * x + k_y * y + phase_shift) over all terms.
+
+  Loops explicitly over grid points and terms so that, when compiled with
+  numba, no [X, Y, term] temporary is created. Grid rows are processed in
+  parallel; the reduction over terms runs serially within each grid point.
+
+  Args:
+    x: x coordinates of the mesh, with shape [X, Y].
+    y: y coordinates of the mesh, with shape [X, Y].
+    terms: C-contiguous array with shape [term, 4], holding the angular
+      x-wavenumber, angular y-wavenumber, phase shift and weight of each term.
+      Packing them keeps all coefficients of a term on the same cache line.
+
+  Returns:
+    Array with shape [X, Y] and the same dtype as x.
+  """
+  size_x, size_y = x.shape
+  out = np.empty((size_x, size_y), dtype=x.dtype)
+  for i in _prange(size_x):
+    for j in range(size_y):
+      total = 0.0
+      x_ij = x[i, j]
+      y_ij = y[i, j]
+      # scalar indexing (rather than unpacking terms[t]) keeps this loop free
+      # of array views, so LLVM can vectorize the reduction and, with
+      # fastmath, use a SIMD sin() (e.g., Intel SVML) where one is available
+      for t in range(terms.shape[0]):
+        total += terms[t, 3] * np.sin(
+            terms[t, 0] * x_ij + terms[t, 1] * y_ij + terms[t, 2])
+      out[i, j] = total
+  return out
+
+
+if numba is not None:
+  _prange = numba.prange
+  _sum_of_sines = numba.njit(parallel=True, fastmath=True)(_sum_of_sines)
+else:
+  _prange = range
+
+
+@tf.function
+def _sum_of_sines_tf(x, y, k_x, k_y, phase_shifts, weights):
+  """TensorFlow implementation of _sum_of_sines."""
+  # We use the axis order [x, y, term]
+  phase = (k_x * x[..., tf.newaxis] + k_y * y[..., tf.newaxis]
+           + phase_shifts)
+  # einsum lowers the reduction over terms to a matrix-vector product, which
+  # XLA can fuse with the sin() into a single kernel
+  return tf.einsum('xyt,t->xy', tf.sin(phase), weights)
+
+
+@tf.function
+def _sum_of_sines_xla(x, y, k_x, k_y, phase_shifts, weights):
+  """Like _sum_of_sines_tf, but compiled with XLA."""
+  # Wrapping xla.compile in a tf.function means it is traced (and compiled)
+  # once per input signature, rather than on every call in eager mode.
+  # A single output is returned by xla.compile wrapped in a tuple.
+  result, = tf.contrib.compiler.xla.compile(
+      _sum_of_sines_tf, [x, y, k_x, k_y, phase_shifts, weights])
+  return result
+
+
+def _sum_terms(waves, weights, shape):
+  """Weighted sum over the trailing term axis of waves, as a single GEMV.
+
+  Args:
+    waves: array with shape [X * Y, term].
+    weights: array with shape [term] or [term, N], in which case N weighted sums
+      are calculated at once (as a GEMM).
+    shape: spatial shape [X, Y] of the result.
+
+  Returns:
+    Array with shape [X, Y] or [X, Y, N].
+  """
+  # A matrix-vector product is dispatched to BLAS and fuses the multiply and
+  # sum, rather than materializing the weighted product weights * waves as a
+  # full-size temporary before reducing it.
+  return (waves @ weights).reshape(tuple(shape) + weights.shape[1:])
+
+
+def _current_device() -> str:
+  """Name of the device requested by the enclosing tf.device() scope, if any.
+
+  Read from the eager context, so no tensor has to be created (and copied to
+  the device) just to find out where new tensors would be placed. Outside any
+  tf.device() scope this is the empty string, i.e., the default device.
+  """
+  return context.context().device_name
+
+
+# maximum number of evaluate_tf() inputs cached per field
+_MAX_CACHED_TF_INPUTS = 8
 
 
 T = TypeVar('T')
@@ -106,13 +207,15 @@ class ConstantVelocityField(VelocityField):
     x_wavenumbers: ndarray of integer spatial x-frequencies of sin() terms.
     y_wavenumbers: ndarray of integer spatial y-frequencies of sin() terms.
     phase_shifts: ndarray of float phase shifts of sin() terms.
+    dtype: floating point dtype in which the field is evaluated.
   """
 
   def __init__(self,
                x_wavenumbers: np.ndarray,
                y_wavenumbers: np.ndarray,
                amplitudes: np.ndarray,
-               phase_shifts: np.ndarray):
+               phase_shifts: np.ndarray,
+               dtype: Any = np.float64):
     """Constructor."""
     if not (x_wavenumbers.shape == y_wavenumbers.shape ==
             amplitudes.shape == phase_shifts.shape):
@@ -121,6 +224,33 @@ class ConstantVelocityField(VelocityField):
     self.y_wavenumbers = y_wavenumbers
     self.amplitudes = amplitudes
     self.phase_shifts = phase_shifts
+    self.dtype = dtype
+
+    # Per-term parameters used for evaluation, which are fixed once the field
+    # is constructed (normalize() returns a new field). Terms with zero weight
+    # in both components (e.g., k_x == k_y == 0) contribute nothing and are
+    # dropped entirely.
+    weights_x = y_wavenumbers * amplitudes
+    weights_y = -x_wavenumbers * amplitudes
+    terms = np.flatnonzero((weights_x != 0) | (weights_y != 0))
+    self._angular_x_wavenumbers = 2 * np.pi * x_wavenumbers[terms]
+    self._angular_y_wavenumbers = 2 * np.pi * y_wavenumbers[terms]
+    self._term_phase_shifts = phase_shifts[terms].astype(dtype)
+    self._term_weights = {
+        VelocityComponent.X: weights_x[terms].astype(dtype),
+        VelocityComponent.Y: weights_y[terms].astype(dtype),
+    }
+    # Paths that evaluate a single component also skip the terms that only
+    # contribute to the other one (e.g., k_y == 0 for the x component).
+    self._active_terms = {
+        component: np.flatnonzero(weights)
+        for component, weights in self._term_weights.items()
+    }
+
+    # Caches owned by this field, so they are released along with it.
+    self._wavenumbers_cache = {}
+    self._sin_phase_cache = {}
+    self._tf_inputs_cache = {}
 
   @property
   def num_terms(self) -> int:
@@ -149,22 +279,39 @@ class ConstantVelocityField(VelocityField):
       shift: Number of half-step shifts on the grid along x and y axes.
 
     Returns:
-      Float64 array with shape [X, Y] giving requested velocity field component.
+      Array with shape [X, Y] and the dtype of this field giving requested
+      velocity field component.
     """
+    return self._weighted_sum(
+        component, grid, shift, self._term_weights[component])
 
-    x, y = grid.get_mesh(shift)
+  def evaluate_both(
+      self,
+      grid: grids.Grid,
+      shift: Tuple[int, int] = (0, 0),
+  ) -> Tuple[np.ndarray, np.ndarray]:
+    """Evaluate both components of this velocity field on the given grid.
+
+    Equivalent to calling evaluate() for each component, but the sin() terms
+    are only calculated once and shared by both components.
 
-    # We use the axis order [x, y, term]
-    x = x[..., np.newaxis]
-    y = y[..., np.newaxis]
+    Args:
+      grid: Grid object defining the mesh on which velocity is evaluated.
+      shift: Number of half-step shifts on the grid along x and y axes.
 
-    k_x = 2 * np.pi * self.x_wavenumbers / grid.length_x
-    k_y = 2 * np.pi * self.y_wavenumbers / grid.length_y
+    Returns:
+      Tuple of x and y components of the velocity field, each an array with
+      shape [X, Y] and the dtype of this field.
+    """
+    sin_phase = self._sin_phase(grid, tuple(shift))
+    return self._sum_both_components(sin_phase, grid.shape)
 
-    phase = k_x * x + k_y * y + self.phase_shifts
-    calculate_vx = component is VelocityComponent.X
-    scale = self.y_wavenumbers if calculate_vx else -self.x_wavenumbers
-    return (scale * self.amplitudes * np.sin(phase)).sum(axis=-1)
+  def _sum_both_components(self, sin_phase, shape):
+    """Both velocity components from a basis of sin() terms, with one GEMM."""
+    weights = np.stack([self._term_weights[VelocityComponent.X],
+                        self._term_weights[VelocityComponent.Y]], axis=1)
+    velocity = _sum_terms(sin_phase, weights, shape)
+    return velocity[..., 0], velocity[..., 1]
 
   def face_average(
       self,
@@ -183,25 +330,155 @@ class ConstantVelocityField(VelocityField):
       shift: Number of half-step shifts on the grid along x and y axes.
 
     Returns:
-      Float64 array with shape [X, Y] giving requested velocity field component.
+      Array with shape [X, Y] and the dtype of this field giving requested
+      velocity field component.
     """
-    x, y = grid.get_mesh(shift)
+    # Averaging over the face only rescales each sin() term (see
+    # _face_average_weights), so this shares all the work of evaluate().
+    return self._weighted_sum(
+        component, grid, shift, self._face_average_weights(component, grid))
 
-    # We use the axis order [x, y, term]
-    x = x[..., np.newaxis]
-    y = y[..., np.newaxis]
+  def evaluate_tf(
+      self,
+      component: VelocityComponent,
+      grid: grids.Grid,
+      shift: Tuple[int, int] = (0, 0),
+      face_average: bool = False,
+      xla_compile: bool = False,
+  ) -> tf.Tensor:
+    """Evaluate this velocity field on the given grid with TensorFlow ops.
 
-    k_x = 2 * np.pi * self.x_wavenumbers / grid.length_x  # shape: [term]
-    k_y = 2 * np.pi * self.y_wavenumbers / grid.length_y  # shape: [term]
+    Like evaluate() and face_average(), but builds the result from TensorFlow
+    ops, which avoids a round trip through NumPy (and a host to device copy)
+    when the field is used inside a TensorFlow computation. The computation is
+    traced once per grid shape. In eager mode, the tensors holding the mesh
+    and term parameters are cached, so repeated calls reuse tensors already
+    resident on the device rather than converting NumPy arrays each time.
+
+    Args:
+      component: Component of the velocity to be evaluated.
+      grid: Grid object defining the mesh on which velocity is evaluated.
+      shift: Number of half-step shifts on the grid along x and y axes.
+      face_average: If true, return the average over the face of a grid cell
+        rather than point values directly.
+      xla_compile: whether to compile with XLA or not.
 
-    phase = self.phase_shifts
-    calculate_vx = component is VelocityComponent.X
-    scale = self.y_wavenumbers if calculate_vx else -self.x_wavenumbers
-    if calculate_vx:
-      waves = _block_average_of_sin(k_y, y, k_x * x + phase, grid.step)
+    Returns:
+      Tensor with shape [X, Y] and the dtype of this field giving requested
+      velocity field component.
+    """
+    args = (component, grid, tuple(shift), face_average)
+    if tf.executing_eagerly():
+      # tensors are pinned to the device that was active when they were
+      # created, so the device is part of the cache key
+      key = args + (_current_device(),)
+      if key not in self._tf_inputs_cache:
+        if len(self._tf_inputs_cache) >= _MAX_CACHED_TF_INPUTS:
+          # evict the oldest entry
+          del self._tf_inputs_cache[next(iter(self._tf_inputs_cache))]
+        self._tf_inputs_cache[key] = self._tf_inputs(*args)
+      inputs = self._tf_inputs_cache[key]
+    else:
+      # tensors created while building a graph belong to that graph, so they
+      # can't be reused
+      inputs = self._tf_inputs(*args)
+    if xla_compile:
+      return _sum_of_sines_xla(*inputs)
+    return _sum_of_sines_tf(*inputs)
+
+  def _tf_inputs(self, component, grid, shift, face_average):
+    """Tensors holding the mesh and active term parameters for evaluate_tf."""
+    x, y = self._mesh(grid, shift)
+    active = self._active_terms[component]
+    k_x, k_y = self._wavenumbers(grid.length_x, grid.length_y)
+    if face_average:
+      weights = self._face_average_weights(component, grid)
     else:
-      waves = _block_average_of_sin(k_x, x, k_y * y + phase, grid.step)
-    return (scale * self.amplitudes * waves).sum(axis=-1)
+      weights = self._term_weights[component]
+    # tf.identity copies each constant onto the default device (e.g., a GPU)
+    return tuple(tf.identity(tf.constant(array)) for array in
+                 [x, y, k_x[active], k_y[active],
+                  self._term_phase_shifts[active], weights[active]])
+
+  def _weighted_sum(self, component, grid, shift, weights):
+    """Sum of sin() terms on the mesh, scaled by the given term weights."""
+    if numba is not None:
+      x, y = self._mesh(grid, shift)
+      return _sum_of_sines(x, y, self._packed_terms(component, grid, weights))
+    sin_phase = self._sin_phase(grid, tuple(shift))
+    return _sum_terms(sin_phase, weights, grid.shape)
+
+  def _face_average_weights(self, component, grid):
+    """Term weights for averages over the faces of grid cells.
+
+    The average of sin(k * x + phi) over [x - step/2, x + step/2] is
+    sinc(k * step / 2) * sin(k * x + phi), so face averages are point values
+    with each term scaled by the sinc of its wavenumber perpendicular to the
+    face.
+
+    Args:
+      component: Component of the velocity to be evaluated.
+      grid: Grid object defining the mesh on which velocity is evaluated.
+
+    Returns:
+      Array of weights with shape [term].
+    """
+    k_x, k_y = self._wavenumbers(grid.length_x, grid.length_y)
+    k = k_y if component is VelocityComponent.X else k_x
+    # np.sinc(z) = sin(pi z) / (pi z), which is 1 at k == 0
+    sinc = np.sinc(k * grid.step / (2 * np.pi))
+    return self._term_weights[component] * sinc
+
+  def _packed_terms(self, component, grid, weights):
+    """Parameters of active terms packed into one array with shape [term, 4]."""
+    k_x, k_y = self._wavenumbers(grid.length_x, grid.length_y)
+    packed = np.stack([k_x, k_y, self._term_phase_shifts, weights], axis=1)
+    return packed[self._active_terms[component]]
+
+  def _wavenumbers(self, length_x: float, length_y: float):
+    """Angular wavenumbers of all terms, scaled to the domain's lengths."""
+    key = (length_x, length_y)
+    if key not in self._wavenumbers_cache:
+      k_x = self._angular_x_wavenumbers / length_x  # shape: [term]
+      k_y = self._angular_y_wavenumbers / length_y  # shape: [term]
+      self._wavenumbers_cache[key] = (k_x.astype(self.dtype, copy=False),
+                                      k_y.astype(self.dtype, copy=False))
+    return self._wavenumbers_cache[key]
+
+  def _mesh(self, grid, shift):
+    """Mesh generated by the grid, in the dtype of this field."""
+    x, y = grid.get_mesh(shift)
+    return x.astype(self.dtype, copy=False), y.astype(self.dtype, copy=False)
+
+  def _mesh_and_wavenumbers(self, grid, shift):
+    """Flattened mesh with a term axis, and wavenumbers scaled to the grid."""
+    x, y = self._mesh(grid, shift)
+
+    # We use the axis order [x * y, term], so that the terms of each grid point
+    # are contiguous and reductions over terms are a matrix-vector product.
+    x = x.reshape(-1, 1)
+    y = y.reshape(-1, 1)
+
+    k_x, k_y = self._wavenumbers(grid.length_x, grid.length_y)
+    return x, y, k_x, k_y
+
+  def _sin_phase(self, grid: grids.Grid, shift: Tuple[int, int]) -> np.ndarray:
+    """Values of all sin() terms on the mesh, with shape [X * Y, term]."""
+    # Both velocity components (and repeated calls at the same shift) share the
+    # same basis of sin() terms, so we cache it. Only the most recently used
+    # basis is kept, since each one is [X * Y, term] in size and most callers
+    # never return to an earlier grid or shift. Grid is a NamedTuple and hence
+    # hashable; shift must be passed as a tuple.
+    key = (grid, shift)
+    if key not in self._sin_phase_cache:
+      self._sin_phase_cache.clear()
+      self._sin_phase_cache[key] = self._compute_sin_phase(grid, shift)
+    return self._sin_phase_cache[key]
+
+  def _compute_sin_phase(self, grid, shift):
+    """Like _sin_phase(), but without caching the result."""
+    x, y, k_x, k_y = self._mesh_and_wavenumbers(grid, shift)
+    return _sin_of_phase(x, y, k_x, k_y, self._term_phase_shifts)
 
   def get_velocity_x(
       self,
@@ -236,6 +513,7 @@ class ConstantVelocityField(VelocityField):
       power_law: float = -3,
       seed: int = None,
       normalize: bool = True,
+      dtype: Any = np.float64,
   ) -> VelocityField:
     """Creates an instance of a ConstantVelocityField from a random seed.
 
@@ -249,31 +527,63 @@ class ConstantVelocityField(VelocityField):
       seed: Seed for random number generator.
       normalize: If True, normalize the field to have a maximum velocity of
         approximately one.
+      dtype: floating point dtype in which the field is evaluated.
 
     Returns:
       ConstantVelocityField object.
     """
     rnd_gen = np.random.RandomState(seed=seed)
     ks = np.arange(-max_periods, max_periods + 1)
-    k_x, k_y = [k.ravel() for k in np.meshgrid(ks, ks, indexing='ij')]
+    # equivalent to raveling np.meshgrid(ks, ks, indexing='ij')
+    index = np.arange(ks.size ** 2)
+    k_x = ks[index // ks.size]
+    k_y = ks[index % ks.size]
     scale = ((k_x ** 2 + k_y ** 2) ** 0.5 + 1) ** float(power_law)
-    amplitudes = scale * rnd_gen.random_sample(size=scale.shape)
-    phase_shifts = rnd_gen.random_sample(size=scale.shape) * np.pi * 2.
-    vfield = cls(k_x, k_y, amplitudes, phase_shifts)
+    # a single draw consumes the random stream in the same order as drawing
+    # amplitudes and then phase shifts
+    amplitude_samples, phase_samples = rnd_gen.random_sample(
+        size=(2,) + scale.shape)
+    amplitudes = scale * amplitude_samples
+    phase_shifts = phase_samples * np.pi * 2.
+    vfield = cls(k_x, k_y, amplitudes, phase_shifts, dtype)
     if normalize:
       vfield = vfield.normalize()
     return vfield
 
-  def normalize(self: T, test_grid_size: int = 256) -> T:
-    """Return a new field with maximum velocity scaled to approximately one."""
-    length = 2 * np.pi
-    step = length / test_grid_size
-    test_grid = grids.Grid(test_grid_size, test_grid_size, step)
+  def normalize(
+      self: T,
+      test_grid_size: int = 256,
+      upper_bound: bool = False,
+  ) -> T:
+    """Return a new field with maximum velocity scaled to approximately one.
+
+    Args:
+      test_grid_size: number of grid points along each axis of the test grid
+        on which the maximum velocity is found.
+      upper_bound: If True, scale by an analytic upper bound on the velocity
+        instead of evaluating the field on a test grid. This takes O(num_terms)
+        time, but only guarantees a maximum velocity of at most one.
 
-    v_x = self.evaluate(VelocityComponent.X, test_grid)
-    v_y = self.evaluate(VelocityComponent.Y, test_grid)
-    v_max = np.sqrt(v_x ** 2 + v_y ** 2).max()
+    Returns:
+      New field with rescaled amplitudes.
+    """
+    if upper_bound:
+      # |sin| <= 1, so each component is bounded by the sum of its weights
+      v_max = np.hypot(abs(self.y_wavenumbers * self.amplitudes).sum(),
+                       abs(self.x_wavenumbers * self.amplitudes).sum())
+    else:
+      length = 2 * np.pi
+      step = length / test_grid_size
+      test_grid = grids.Grid(test_grid_size, test_grid_size, step)
+
+      # always calibrate in float64, even if this field uses lower precision
+      reference = type(self)(self.x_wavenumbers, self.y_wavenumbers,
+                             self.amplitudes, self.phase_shifts)
+      # the test grid is never reused, so don't cache its (large) basis
+      sin_phase = reference._compute_sin_phase(test_grid, (0, 0))
+      v_x, v_y = reference._sum_both_components(sin_phase, test_grid.shape)
+      v_max = np.sqrt(v_x ** 2 + v_y ** 2).max()
     amplitudes = self.amplitudes / v_max
 
     return type(self)(self.x_wavenumbers, self.y_wavenumbers,
-                      amplitudes, self.phase_shifts)
+                      amplitudes, self.phase_shifts, self.dtype)
@@ -12,6 +12,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # ==============================================================================
+from unittest import mock
+
 import numpy as np
 from datadrivenpdes.advection import equations as advection_equations
 from datadrivenpdes.advection import velocity_fields
@@ -128,6 +130,102 @@ class ConstantVelocityFieldTest(absltest.TestCase):
       np.testing.assert_allclose(divergence, np.zeros_like(divergence),
                                  atol=1e-8)
 
+  def test_evaluate_both(self):
+    vfield = velocity_fields.ConstantVelocityField.from_seed(seed=0)
+    for shift in [(0, 0), (1, 0), (0, 1)]:
+      with self.subTest(f'{shift}'):
+        v_x, v_y = vfield.evaluate_both(self.grid, shift)
+        np.testing.assert_allclose(
+            v_x, vfield.evaluate(velocity_fields.VelocityComponent.X,
+                                 self.grid, shift), atol=1e-10)
+        np.testing.assert_allclose(
+            v_y, vfield.evaluate(velocity_fields.VelocityComponent.Y,
+                                 self.grid, shift), atol=1e-10)
+
+  def test_evaluate_tf(self):
+    vfield = velocity_fields.ConstantVelocityField.from_seed(seed=0)
+    for component in velocity_fields.VelocityComponent:
+      for shift in [(0, 0), (1, 0), (0, 1)]:
+        with self.subTest(f'{component}, {shift}'):
+          expected = vfield.evaluate(component, self.grid, shift)
+          actual = vfield.evaluate_tf(component, self.grid, shift)
+          np.testing.assert_allclose(actual, expected, atol=1e-10)
+
+        with self.subTest(f'{component}, {shift}, face_average'):
+          expected = vfield.face_average(component, self.grid, shift)
+          actual = vfield.evaluate_tf(
+              component, self.grid, shift, face_average=True)
+          np.testing.assert_allclose(actual, expected, atol=1e-10)
+
+        with self.subTest(f'{component}, {shift}, xla'):
+          expected = vfield.evaluate(component, self.grid, shift)
+          actual = vfield.evaluate_tf(
+              component, self.grid, shift, xla_compile=True)
+          np.testing.assert_allclose(actual, expected, atol=1e-7)
+
+  def test_backends(self):
+    random_field = velocity_fields.ConstantVelocityField.from_seed(seed=0)
+    fields = {
+        'random': random_field,
+        # no term contributes to the velocity
+        'zero amplitudes': velocity_fields.ConstantVelocityField(
+            random_field.x_wavenumbers, random_field.y_wavenumbers,
+            np.zeros_like(random_field.amplitudes),
+            random_field.phase_shifts),
+    }
+
+    def evaluate_all():
+      results = {}
+      for field_name, params in fields.items():
+        # construct a new field, so nothing is reused from another backend's
+        # cache
+        vfield = velocity_fields.ConstantVelocityField(
+            params.x_wavenumbers, params.y_wavenumbers, params.amplitudes,
+            params.phase_shifts)
+        for method in ['evaluate', 'face_average']:
+          for component in velocity_fields.VelocityComponent:
+            for shift in [(0, 0), (1, 0), (0, 1)]:
+              results[field_name, method, component, shift] = getattr(
+                  vfield, method)(component, self.grid, shift)
+        v_x, v_y = vfield.evaluate_both(self.grid)
+        results[field_name, 'evaluate_both', 'x'] = v_x
+        results[field_name, 'evaluate_both', 'y'] = v_y
+      return results
+
+    with mock.patch.object(velocity_fields, 'numba', None), \
+        mock.patch.object(velocity_fields, 'numexpr', None):
+      expected = evaluate_all()
+
+    for key in expected:
+      if key[0] == 'zero amplitudes':
+        np.testing.assert_array_equal(expected[key], 0, err_msg=str(key))
+
+    backends = {
+        'numba': (velocity_fields.numba, {'numexpr': None}),
+        'numexpr': (velocity_fields.numexpr, {'numba': None}),
+    }
+    for name, (module, patches) in backends.items():
+      with self.subTest(name):
+        if module is None:
+          self.skipTest(f'{name} is not installed')
+        with mock.patch.multiple(velocity_fields, **patches):
+          actual = evaluate_all()
+        for key, value in expected.items():
+          np.testing.assert_allclose(actual[key], value, atol=1e-12,
+                                     err_msg=str(key))
+
+  def test_float32(self):
+    vfield64 = velocity_fields.ConstantVelocityField.from_seed(seed=0)
+    vfield32 = velocity_fields.ConstantVelocityField.from_seed(
+        seed=0, dtype=np.float32)
+    for component in velocity_fields.VelocityComponent:
+      for method in ['evaluate', 'face_average']:
+        with self.subTest(f'{component}, {method}'):
+          expected = getattr(vfield64, method)(component, self.grid)
+          actual = getattr(vfield32, method)(component, self.grid)
+          self.assertEqual(actual.dtype, np.float32)
+          np.testing.assert_allclose(actual, expected, atol=1e-5)
+
   def test_normalize(self):
 
     def maximum_velocity(vfield):
@@ -143,6 +241,11 @@ class ConstantVelocityFieldTest(absltest.TestCase):
     new_max_velocity = maximum_velocity(original_vfield.normalize())
     self.assertAlmostEqual(new_max_velocity, 1.0, places=3)
 
+    bounded_max_velocity = maximum_velocity(
+        original_vfield.normalize(upper_bound=True))
+    self.assertLessEqual(bounded_max_velocity, 1.0)
+    self.assertGreater(bounded_max_velocity, 0.1)
+
 
 if __name__ == '__main__':
   absltest.main()
@@ -23,6 +23,12 @@ INSTALL_REQUIRES = [
     'xarray',
 ]
 
+# Optional dependencies for faster evaluation of velocity fields.
+EXTRAS_REQUIRE = {
+    'numba': ['numba'],
+    'numexpr': ['numexpr'],
+}
+
 setuptools.setup(
     name='pde-superresolution-2d',
     version='0.0.0',
@@ -30,6 +36,7 @@ setuptools.setup(
     author='Google LLC',
     author_email='noreply@google.com',
     install_requires=INSTALL_REQUIRES,
+    extras_require=EXTRAS_REQUIRE,
     url='https://github.com/google-research/pde-superresolution-2d',
     packages=setuptools.find_packages(),
     python_requires='>=3')